@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
 
 import asyncio
+import atexit
+import shutil
 import subprocess
 import tempfile
 import base64
+import hashlib
 import logging
+import mmap
+import os
+import re
 import sys
+import uuid
+from collections import OrderedDict, deque
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
@@ -17,148 +25,360 @@ from mcp.server import NotificationOptions, Server
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger(__name__)
 
+_DOCUMENT_START_RE = re.compile(rb'(?:\s|%[^\n]*\n)*\\(?:documentclass|RequirePackage|PassOptionsToPackage|DocumentMetadata)')
+
+
+def _is_full_document(tikz_bytes: bytes) -> bool:
+    if _DOCUMENT_START_RE.match(tikz_bytes):
+        return True
+    return tikz_bytes.find(b'\\documentclass', 0, 4096) != -1
+
+
+def _extract_log_errors(log_bytes: bytes, limit: int = 20) -> List[bytes]:
+    context = deque(maxlen=2)
+    error_lines: List[bytes] = []
+    in_error = False
+    
+    for line in log_bytes.splitlines():
+        line = line.strip()
+        if line.startswith(b'! '):
+            if not in_error:
+                error_lines.extend(context)
+                context.clear()
+            error_lines.append(line)
+            in_error = True
+        elif in_error:
+            if line:
+                error_lines.append(line)
+            else:
+                in_error = False
+        elif line:
+            context.append(line)
+        
+        if len(error_lines) >= limit:
+            break
+    
+    return error_lines[:limit]
+
+
+def _read_log(log_file: Path, tail_size: int = 65536) -> Optional[bytes]:
+    if not log_file.exists():
+        return None
+    
+    with open(log_file, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - tail_size))
+        tail = f.read()
+        if size <= tail_size or b'\n! ' in tail:
+            return tail
+        f.seek(0)
+        return f.read()
+
+
+def _source_key(tikz_bytes: bytes) -> bytes:
+    return hashlib.blake2b(tikz_bytes, digest_size=16).digest()
+
+
+def _describe_latex_failure(log_bytes: Optional[bytes], stderr: Optional[bytes]) -> str:
+    stderr_text = stderr.decode('utf-8', errors='ignore') if stderr else ""
+    if log_bytes is None:
+        return stderr_text or "LaTeX compilation failed - no log file generated"
+    
+    error_lines = _extract_log_errors(log_bytes)
+    if error_lines:
+        error_details = b'\n'.join(error_lines).decode('utf-8', errors='ignore')
+    else:
+        last_lines = [line for line in log_bytes.splitlines()[-50:] if line.strip()]
+        error_details = b'\n'.join(last_lines[-15:]).decode('utf-8', errors='ignore')
+    
+    return error_details or stderr_text or "LaTeX compilation failed with unknown error"
+
 
 class TikZMCPServer:
-    def __init__(self):
+    _CACHE_SIZE = 128
+    _COMPILE_TIMEOUT = 120
+    
+    _PRELOAD_PREAMBLE = """\\documentclass[border=2pt]{standalone}
+\\usepackage{tikz}
+\\usepackage{amsmath}
+\\usepackage{amssymb}
+\\usepackage{xcolor}
+\\usetikzlibrary{shapes,arrows,positioning,calc,arrows.meta}
+"""
+    _PRELOAD_PREAMBLES = {
+        "tikzfast": _PRELOAD_PREAMBLE,
+        "tikzplots": _PRELOAD_PREAMBLE + "\\usepackage{pgfplots}\n\\pgfplotsset{compat=1.18}\n",
+    }
+    _PREAMBLE_BYTES = {
+        name: (preamble + "\\csname endofdump\\endcsname\n").encode('utf-8')
+        for name, preamble in _PRELOAD_PREAMBLES.items()
+    }
+    _FONT_BYTES = {
+        "xelatex": b"\\usepackage{xeCJK}\n\\usepackage{fontspec}\n",
+        "lualatex": b"\\usepackage{fontspec}\n\\usepackage{luatexja-fontspec}\n",
+    }
+    _BEGIN_DOCUMENT_BYTES = b"\n\\begin{document}\n"
+    _POSTAMBLE_BYTES = b"\n\\end{document}\n"
+    _LIB_KEYWORDS = {
+        b'decorations.pathreplacing': (b'decorat',),
+        b'patterns': (b'pattern',),
+        b'fit': (b'fit',),
+        b'backgrounds': (b'background', b'framed', b'gridded'),
+        b'mindmap': (b'mindmap', b'concept'),
+        b'trees': (b'child', b'grow'),
+        b'angles': (b'angle',),
+        b'quotes': (b'"',),
+        b'plotmarks': (b'mark',),
+    }
+    _PGFPLOTS_MARKERS = (b'\\pgfplots', b'axis}', b'\\addplot')
+    
+    def __init__(self, compile_timeout: Optional[float] = None):
         self.server = Server("tikz-renderer")
         self.server_name = "tikz-renderer"
         self.server_version = "0.1.0"
+        self._xelatex = shutil.which("xelatex")
+        self._lualatex = shutil.which("lualatex")
+        self._pdfcrop = shutil.which("pdfcrop")
+        self._pdftoppm = shutil.which("pdftoppm")
+        self._gs = shutil.which("gs")
+        self._convert = shutil.which("convert") or shutil.which("magick")
+        self._formats: Dict[str, Optional[str]] = {}
+        self._format_lock = asyncio.Lock()
+        self._compile_semaphore = asyncio.Semaphore(max(1, (os.cpu_count() or 2) - 1))
+        if compile_timeout is None:
+            compile_timeout = float(os.environ.get("TIKZ_COMPILE_TIMEOUT", self._COMPILE_TIMEOUT))
+        self._compile_timeout = compile_timeout if compile_timeout > 0 else None
+        self._cache: OrderedDict[bytes, str] = OrderedDict()
+        self._lualatex_keys: OrderedDict[bytes, None] = OrderedDict()
+        self._tmp_root = "/dev/shm" if Path("/dev/shm").is_dir() else None
+        self._scratch = Path(tempfile.mkdtemp(prefix="tikzmcp-", dir=self._tmp_root))
+        atexit.register(shutil.rmtree, self._scratch, ignore_errors=True)
+        self._format_dir = self._scratch / "formats"
+        self._format_dir.mkdir()
     
-    def compile_tikz_to_image(self, tikz_code: str) -> str:
+    async def _run(self, args: List[str], cwd: str) -> None:
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd
+        )
         try:
-            subprocess.run(["xelatex", "--version"], check=True, capture_output=True)
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            raise RuntimeError("xelatex not found. Please install TeX Live or MiKTeX.")
+            _, stderr = await proc.communicate()
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+            raise
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, args, stderr=stderr)
+    
+    async def _ensure_format(self, name: str) -> Optional[str]:
+        async with self._format_lock:
+            if name not in self._formats:
+                self._formats[name] = await self._build_format(name)
+        return self._formats[name]
+    
+    async def _build_format(self, name: str) -> Optional[str]:
+        (self._format_dir / f"{name}.tex").write_text(
+            self._PRELOAD_PREAMBLES[name] + "\\csname endofdump\\endcsname\n\\begin{document}\n\\end{document}\n",
+            encoding='utf-8'
+        )
         
         try:
-            subprocess.run(["convert", "--version"], check=True, capture_output=True)
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            raise RuntimeError("ImageMagick convert not found. Please install ImageMagick.")
+            await self._run([
+                self._xelatex,
+                "-ini",
+                "-interaction=batchmode",
+                f"-jobname={name}",
+                "&xelatex", "mylatexformat.ltx", f"{name}.tex"
+            ], cwd=str(self._format_dir))
+        except subprocess.CalledProcessError:
+            logger.warning("Could not build preloaded format %s, falling back to full preamble", name)
+            return None
         
-        with tempfile.TemporaryDirectory() as temp_dir:
-            tex_file = Path(temp_dir) / "diagram.tex"
-            
-            if '\\documentclass' in tikz_code:
-                latex_content = tikz_code
-            else:
-                latex_content = f"""\\documentclass[border=2pt]{{standalone}}
-\\usepackage{{xeCJK}}
-\\usepackage{{fontspec}}
-\\usepackage{{tikz}}
-\\usepackage{{pgfplots}}
-\\usepackage{{amsmath}}
-\\usepackage{{amssymb}}
-\\usepackage{{xcolor}}
-\\usetikzlibrary{{shapes,arrows,positioning,calc,decorations.pathreplacing,patterns,fit,backgrounds,mindmap,trees,arrows.meta,angles,quotes}}
-\\pgfplotsset{{compat=1.18}}
-
-\\begin{{document}}
-{tikz_code}
-\\end{{document}}
-"""
-            
-            tex_file.write_text(latex_content, encoding='utf-8')
-            
-            try:
-                result = subprocess.run([
-                    "xelatex", 
-                    "-interaction=nonstopmode",
-                    "-output-directory", temp_dir,
-                    str(tex_file)
-                ], check=True, capture_output=True, text=True, cwd=temp_dir)
-            except subprocess.CalledProcessError as e:
-                log_file = Path(temp_dir) / "diagram.log"
-                error_details = ""
-                if log_file.exists():
-                    log_content = log_file.read_text(encoding='utf-8', errors='ignore')
-                    lines = log_content.split('\n')
-                    
-                    error_section = False
-                    error_lines = []
-                    context_lines = []
+        if not (self._format_dir / f"{name}.fmt").exists():
+            return None
+        return str(self._format_dir / name)
+    
+    def _build_document(self, tikz_bytes: bytes, engine: str, fmt_name: str) -> bytes:
+        parts = [self._PREAMBLE_BYTES[fmt_name], self._FONT_BYTES[engine]]
+        
+        libraries = [
+            library for library, keywords in self._LIB_KEYWORDS.items()
+            if any(keyword in tikz_bytes for keyword in keywords)
+        ]
+        if libraries:
+            parts.append(b'\\usetikzlibrary{' + b','.join(libraries) + b'}\n')
+        
+        parts += [self._BEGIN_DOCUMENT_BYTES, tikz_bytes, self._POSTAMBLE_BYTES]
+        return b''.join(parts)
+    
+    def _format_name(self, tikz_bytes: bytes) -> str:
+        if any(marker in tikz_bytes for marker in self._PGFPLOTS_MARKERS):
+            return "tikzplots"
+        return "tikzfast"
+    
+    async def _run_engine(self, engine: str, job_dir: Path, tikz_bytes: bytes, is_document: bool) -> None:
+        tex_file = job_dir / "diagram.tex"
+        
+        if is_document:
+            latex_content = tikz_bytes
+            fmt_args = []
+        else:
+            fmt_name = self._format_name(tikz_bytes)
+            latex_content = self._build_document(tikz_bytes, engine, fmt_name)
+            fmt_file = await self._ensure_format(fmt_name) if engine == "xelatex" else None
+            fmt_args = [f"-fmt={fmt_file}"] if fmt_file else []
+        
+        tex_file.write_bytes(latex_content)
+        
+        await self._run([
+            self._lualatex if engine == "lualatex" else self._xelatex, 
+            *fmt_args,
+            "-interaction=batchmode",
+            "-halt-on-error",
+            "-output-directory", str(job_dir),
+            str(tex_file)
+        ], cwd=str(job_dir))
+    
+    async def compile_tikz_to_image(self, tikz_bytes: bytes, key: bytes) -> str:
+        if not self._xelatex:
+            raise RuntimeError("xelatex not found. Please install TeX Live or MiKTeX.")
+        
+        if not self._pdftoppm and not self._gs and not self._convert:
+            raise RuntimeError("pdftoppm, Ghostscript or ImageMagick not found. Please install Poppler.")
+        
+        is_document = _is_full_document(tikz_bytes)
+        if key in self._lualatex_keys:
+            engines = ["lualatex"]
+        elif self._lualatex:
+            engines = ["xelatex", "lualatex"]
+        else:
+            engines = ["xelatex"]
+        
+        if not is_document and engines[0] == "xelatex":
+            await self._ensure_format(self._format_name(tikz_bytes))
+        
+        try:
+            return await asyncio.wait_for(
+                self._compile_job(tikz_bytes, key, is_document, engines),
+                timeout=self._compile_timeout
+            )
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"Rendering timed out after {self._compile_timeout:g} seconds")
+    
+    async def _compile_job(self, tikz_bytes: bytes, key: bytes, is_document: bool, engines: List[str]) -> str:
+        job_dir = self._scratch / uuid.uuid4().hex
+        job_dir.mkdir()
+        try:
+            failure: Optional[str] = None
+            for engine in engines:
+                try:
+                    await self._run_engine(engine, job_dir, tikz_bytes, is_document)
+                except subprocess.CalledProcessError as e:
+                    log_bytes = _read_log(job_dir / "diagram.log")
+                    if failure is None:
+                        failure = _describe_latex_failure(log_bytes, e.stderr)
                     
-                    for i, line in enumerate(lines):
-                        line_clean = line.strip()
-                        
-                        if any(keyword in line.lower() for keyword in ['! ', 'error:', 'undefined', 'missing']):
-                            error_section = True
-                            error_lines.append(line_clean)
-                            for j in range(max(0, i-2), i):
-                                if lines[j].strip() and lines[j].strip() not in context_lines:
-                                    context_lines.append(lines[j].strip())
-                            continue
-                        
-                        if error_section:
-                            if line_clean:
-                                if line.startswith('l.') or 'line' in line.lower():
-                                    error_lines.append(line_clean)
-                                elif any(char in line for char in ['^', '?']):
-                                    error_lines.append(line_clean)
-                                elif line_clean.startswith('\\') or '\\' in line_clean:
-                                    error_lines.append(line_clean)
-                                elif len(error_lines) < 10:
-                                    error_lines.append(line_clean)
-                            else:
-                                if len(error_lines) > 0:
-                                    break
+                    if engine != engines[-1] and log_bytes and b'TeX capacity exceeded' in log_bytes:
+                        continue
                     
-                    if context_lines or error_lines:
-                        all_lines = context_lines + ['--- Error Details ---'] + error_lines
-                        error_details = '\n'.join(all_lines[:20]) 
-                    else:
-                        last_lines = [line for line in lines[-50:] if line.strip()]
-                        error_details = '\n'.join(last_lines[-15:])
-                        
-                    if not error_details:
-                        error_details = e.stderr or "LaTeX compilation failed with unknown error"
+                    raise RuntimeError(f"LaTeX compilation failed:\n\n{failure}")
                 else:
-                    error_details = e.stderr or "LaTeX compilation failed - no log file generated"
-                    
-                raise RuntimeError(f"LaTeX compilation failed:\n\n{error_details}")
+                    if engine == "lualatex" and key not in self._lualatex_keys:
+                        self._lualatex_keys[key] = None
+                        if len(self._lualatex_keys) > self._CACHE_SIZE:
+                            self._lualatex_keys.popitem(last=False)
+                    break
             
-            pdf_file = Path(temp_dir) / "diagram.pdf"
+            pdf_file = job_dir / "diagram.pdf"
             if not pdf_file.exists():
                 raise RuntimeError("PDF file was not generated")
             
-            png_file = Path(temp_dir) / "diagram.png"
-            try:
-                subprocess.run([
-                    "convert", 
+            if is_document and self._pdfcrop:
+                cropped_file = job_dir / "diagram-crop.pdf"
+                try:
+                    await self._run([self._pdfcrop, str(pdf_file), str(cropped_file)], cwd=str(job_dir))
+                except subprocess.CalledProcessError:
+                    logger.warning("pdfcrop failed, rasterizing uncropped PDF")
+                else:
+                    if cropped_file.exists():
+                        pdf_file = cropped_file
+            
+            png_file = job_dir / "diagram.png"
+            if self._pdftoppm:
+                convert_args = [
+                    self._pdftoppm,
+                    "-png",
+                    "-r", "300",
+                    "-singlefile",
+                    str(pdf_file),
+                    str(png_file.with_suffix(""))
+                ]
+            elif self._gs:
+                convert_args = [
+                    self._gs,
+                    "-dSAFER", "-dBATCH", "-dNOPAUSE",
+                    "-sDEVICE=png16m",
+                    "-dTextAlphaBits=4", "-dGraphicsAlphaBits=4",
+                    "-r300",
+                    "-o", str(png_file),
+                    str(pdf_file)
+                ]
+            else:
+                convert_args = [
+                    self._convert, 
                     "-density", "300",
-                    "-quality", "90",
                     str(pdf_file),
                     str(png_file)
-                ], check=True, capture_output=True)
+                ]
+            
+            try:
+                await self._run(convert_args, cwd=str(job_dir))
             except subprocess.CalledProcessError as e:
-                raise RuntimeError(f"Image conversion failed: {e}")
+                stderr = e.stderr.decode('utf-8', errors='ignore').strip() if e.stderr else ""
+                raise RuntimeError(f"Image conversion failed: {e}\n{stderr}".rstrip())
             
-            if not png_file.exists():
+            if not png_file.exists() or png_file.stat().st_size == 0:
                 raise RuntimeError("PNG file was not generated")
             
-            with open(png_file, "rb") as f:
-                image_data = base64.b64encode(f.read()).decode('utf-8')
+            with open(png_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                image_data = base64.b64encode(mm).decode('ascii')
                 return image_data
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
     
     def setup_handlers(self):
+        tools = [
+            types.Tool(
+                name="render_tikz",
+                description="Render TikZ code to high-quality PNG image. Supports TikZ diagrams, mathematical plots, flowcharts, and technical illustrations.",
+                inputSchema={
+                    "type": "object",
+                    "properties": {
+                        "tikz_code": {
+                            "type": "string",
+                            "description": "TikZ/LaTeX code to render. Can include \\begin{tikzpicture}...\\end{tikzpicture} or full LaTeX document with \\documentclass."
+                        }
+                    },
+                    "required": ["tikz_code"]
+                }
+            )
+        ]
+        invalid_code_content = types.TextContent(
+            type="text",
+            text="Error: Valid TikZ code is required"
+        )
+        rendered_content = types.TextContent(
+            type="text",
+            text="TikZ diagram rendered successfully"
+        )
         
         @self.server.list_tools()
         async def handle_list_tools() -> List[types.Tool]:
-            return [
-                types.Tool(
-                    name="render_tikz",
-                    description="Render TikZ code to high-quality PNG image. Supports TikZ diagrams, mathematical plots, flowcharts, and technical illustrations.",
-                    inputSchema={
-                        "type": "object",
-                        "properties": {
-                            "tikz_code": {
-                                "type": "string",
-                                "description": "TikZ/LaTeX code to render. Can include \\begin{tikzpicture}...\\end{tikzpicture} or full LaTeX document with \\documentclass."
-                            }
-                        },
-                        "required": ["tikz_code"]
-                    }
-                )
-            ]
+            return tools
         
         @self.server.call_tool()
         async def handle_call_tool(
@@ -173,21 +393,24 @@ class TikZMCPServer:
                 tikz_code = arguments.get("tikz_code")
                 
                 if not tikz_code or not isinstance(tikz_code, str):
-                    return [
-                        types.TextContent(
-                            type="text",
-                            text="Error: Valid TikZ code is required"
-                        )
-                    ]
+                    return [invalid_code_content]
+                
+                tikz_bytes = tikz_code.encode('utf-8')
+                key = _source_key(tikz_bytes)
                 
                 try:
-                    image_base64 = self.compile_tikz_to_image(tikz_code)
+                    image_base64 = self._cache.get(key)
+                    if image_base64 is not None:
+                        self._cache.move_to_end(key)
+                    else:
+                        async with self._compile_semaphore:
+                            image_base64 = await self.compile_tikz_to_image(tikz_bytes, key)
+                        self._cache[key] = image_base64
+                        if len(self._cache) > self._CACHE_SIZE:
+                            self._cache.popitem(last=False)
                     
                     return [
-                        types.TextContent(
-                            type="text",
-                            text="TikZ diagram rendered successfully"
-                        ),
+                        rendered_content,
                         types.ImageContent(
                             type="image",
                             data=image_base64,